@@ -30,7 +30,8 @@
 # There are a few limitations:
 # 1. we assume old records don't change for now; we don't go back and resample an old record.
 #    there are a few ways to workaround this later.
-# 2. it would be nice to plugin to the Mongo streaming API.
+# 2. polling on _id is the default; collections can opt in to the Mongo change stream API
+#    (use_change_stream), which needs a replica set.
 # 3. this assumes instantiation from cron or something similar; we don't provide job control around it.
 # 
 
@@ -38,13 +39,17 @@ import argparse
 import dotenv
 import json
 import logging
+import math
 import os
 import pickle
+import queue
+import re
 import sys
 import sqlite3
-import time
+import threading
 import yaml
 
+import concurrent.futures
 import decimal
 import pymongo
 import bson
@@ -56,8 +61,21 @@ from dataculpa import DataCulpaValidator
 
 from pymongo import MongoClient, ASCENDING
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Prefer the libyaml bindings when PyYAML was built with them.
+try:
+    from yaml import CSafeLoader as YamlSafeLoader, CSafeDumper as YamlSafeDumper
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader, SafeDumper as YamlSafeDumper
+
 DEBUG = False
 
+logger = logging.getLogger("mongo-dataculpa")
+
 def FatalError(message, rc=2):
     sys.stderr.write(message)
     sys.stderr.write("\n")
@@ -70,18 +88,78 @@ def FatalError(message, rc=2):
 if sys.version_info[0] < 3:
     raise Exception("This code requires python 3")
 
+def _encode_decimal(o):
+    return f'{o.normalize():f}'  # using normalize() gets rid of trailing 0s, using ':f' prevents scientific notation
+
+# Exact-type dispatch for MongoJSONEncoder.default; one dict lookup instead of an isinstance() chain.
+_MONGO_JSON_HANDLERS = {
+    bson.ObjectId:   str,
+    decimal.Decimal: _encode_decimal,
+    #    datetime: iso.datetime_isoformat,
+}
+
 class MongoJSONEncoder(json.JSONEncoder):
-    def default(self, o):  # pylint: disable=E0202
-        if isinstance(o, bson.ObjectId):
-            return str(o)
-        #        if isinstance(o, (datetime, date)):
-        #            return iso.datetime_isoformat(o)
+    def __init__(self, *, default=None, **kwargs):
+        # The Validator client passes default=str, which JSONEncoder would install
+        # over our default() method; keep it as the fallback for types we don't
+        # handle instead, so ObjectId and Decimal still go through the handlers.
+        super().__init__(**kwargs)
+        self._fallback_default = default
 
-        if isinstance(o, decimal.Decimal):
-            return f'{o.normalize():f}'  # using normalize() gets rid of trailing 0s, using ':f' prevents scientific notation
+    def default(self, o):  # pylint: disable=E0202
+        h = _MONGO_JSON_HANDLERS.get(type(o))
+        if h is not None:
+            return h(o)
 
+        if self._fallback_default is not None:
+            return self._fallback_default(o)
         return json.JSONEncoder.default(self, o)
 
+    def encode(self, o):
+        # The Validator client calls json.dumps(..., cls=MongoJSONEncoder) on each
+        # queued batch; hand that off to orjson when it's installed. Datetimes are
+        # passed through to default() so they serialize the same way as before.
+        if orjson is None:
+            return json.JSONEncoder.encode(self, o)
+
+        try:
+            s = orjson.dumps(o, default=self.default,
+                             option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # e.g., integers wider than 64 bits
+            return json.JSONEncoder.encode(self, o)
+
+        # orjson writes NaN/Infinity as null, which would make bad floats look like
+        # missing values; only look for them when the output has a null value
+        # (not just the word inside a string). Null-heavy batches pay for the walk.
+        if self.allow_nan and _NULL_VALUE_RE.search(s) is not None and _has_nonfinite(o):
+            return json.JSONEncoder.encode(self, o)
+
+        if self.ensure_ascii and not s.isascii():
+            # Non-ASCII only appears inside strings, so escaping each run keeps
+            # the JSON valid and matches the stdlib's \uXXXX output.
+            s = _NON_ASCII_RE.sub(lambda m: json.encoder.encode_basestring_ascii(m.group(0))[1:-1], s)
+        return s
+
+
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7f]+')
+_NULL_VALUE_RE = re.compile(r'[:,\[]null[,\]}]')
+
+def _has_nonfinite(o):
+    stack = [o]
+    while stack:
+        v = stack.pop()
+        t = type(v)
+        if t == float:
+            if not math.isfinite(v):
+                return True
+        elif t == dict:
+            stack.extend(v.values())
+        elif t == list or t == tuple:
+            stack.extend(v)
+    # endwhile
+    return False
+
 class Config:
     def __init__(self): #, db, host, port, user, password):
         self._d = { 
@@ -105,6 +183,8 @@ class Config:
                         'version': '[optional] a string representing the version of implementation'
                     }
                 }
+        self._dc_access_token = None
+        self._prepare_collections()
 
     def save(self, fname):
         if os.path.exists(fname):
@@ -113,15 +193,94 @@ class Config:
             return
 
         f = open(fname, 'w')
-        yaml.safe_dump(self._d, f, default_flow_style=False)
+        yaml.dump(self._d, f, Dumper=YamlSafeDumper, default_flow_style=False)
         f.close()
         return
 
     def load(self, fname):
         with open(fname, "r") as f:
             #print(f)
-            self._d = yaml.load(f, yaml.SafeLoader)
+            self._d = yaml.load(f, YamlSafeLoader)
             #print(self._d)
+        self._prepare_numbers()
+        self._prepare_collections()
+        return
+
+    @classmethod
+    def _coerce_int(cls, d, field, where):
+        # YAML hands back quoted numbers as strings and blank keys as None; a blank
+        # key is dropped so the usual default applies.
+        if field not in d:
+            return
+
+        v = d[field]
+        if v is None:
+            del d[field]
+            return
+
+        if type(v) == int:
+            return
+
+        if type(v) == str:
+            try:
+                d[field] = int(v)
+                return
+            except ValueError:
+                pass
+        # endif
+        FatalError("'%s' in %s must be an integer; got '%s'" % (field, where, v))
+        return
+
+    def _prepare_numbers(self):
+        # Coerce the numeric settings once at load time instead of on every use.
+        for (section, field) in (('configuration',        'port'),
+                                 ('configuration',        'workers'),
+                                 ('dataculpa_controller', 'port'),
+                                 ('dataculpa_controller', 'queue_window')):
+            d = self._d.get(section)
+            if d is None:
+                continue
+            self._coerce_int(d, field, "the '%s' section" % section)
+        # endfor
+
+        cc = self.get_controller_config()
+        if cc is not None and cc.get('queue_window', 1) <= 0:
+            FatalError("'queue_window' in the 'dataculpa_controller' section must be a positive integer")
+        return
+
+    def _prepare_collections(self):
+        # Check the collection entries and fill in their defaults once at load
+        # time, and build the name -> entry map so lookups don't rescan the list.
+        self._collections_by_name = {}
+        cfg = self.get_configuration()
+        if cfg is None:
+            return
+
+        if cfg.get('collections') is None:
+            cfg['collections'] = []
+
+        for entry in cfg['collections']:
+            if not isinstance(entry, dict) or entry.get('collection') is None:
+                FatalError("Each entry in 'collections' needs a 'collection' name; got: %s" % entry)
+
+            self._coerce_int(entry, 'batch_size', "collection '%s'" % entry['collection'])
+
+            entry.setdefault('enabled', True)
+            entry.setdefault('use_timeshift', True)
+            entry.setdefault('timeshift_field', None)
+            entry.setdefault('batch_size', 1000)
+            entry.setdefault('fields', None)
+            entry.setdefault('use_change_stream', False)
+
+            if entry['batch_size'] <= 0:
+                FatalError("Collection '%s': batch_size must be a positive integer" % entry['collection'])
+
+            fields = entry['fields']
+            if fields is not None and (type(fields) != list or not all(type(f) == str for f in fields)):
+                FatalError("Collection '%s': fields must be a list of field names" % entry['collection'])
+
+            self._collections_by_name[entry['collection']] = entry
+        # endfor
         return
 
     def _get_db(self, field, default_value=None):
@@ -131,18 +290,19 @@ class Config:
     def get_configuration(self):
         return self._d.get('configuration')
     
+    def get_workers(self):
+        return max(1, self._get_db('workers', 4))
+
     def get_local_cache_file(self):
         return self.get_configuration().get('session_history_cache', 'session_history_cache.db')
 
 
     def get_db_mongo(self):
-        port = self._get_db('port', 27017)
-        if type(port) == str:
-            port = int(port)
-        return (self._get_db('host'),
-                port,
-                self._get_db('dbname'),
-                self._get_db('user'),
+        d = self.get_configuration()
+        return (d.get('host'),
+                d.get('port', 27017),
+                d.get('dbname'),
+                d.get('user'),
                 os.environ.get('MONGO_PASSWORD', ''))
 
     def get_controller_config(self):
@@ -155,6 +315,7 @@ class Config:
         host = cc.get('host')
         port = cc.get('port')
         access_id = cc.get('api_key')
+        queue_window = cc.get('queue_window', 1000)
         if access_id is None:
             FatalError("Missing api_key from .yaml config")
 
@@ -162,32 +323,41 @@ class Config:
         if secret is None:
             FatalError("Missing DC_API_SECRET from environment or .env file")
 
+        # _open_queue and a settable api_access_token need dataculpa-client 1.4.1 or
+        # newer; older releases reject _open_queue with a TypeError.
         v = DataCulpaValidator(pipeline_name,
                                protocol=DataCulpaValidator.HTTP,
                                dc_host=host,
                                dc_port=port,
                                api_access_id=access_id,
                                api_secret=secret,
-                               queue_window=1000, 
-                               timeshift=timeshift)
+                               queue_window=queue_window,
+                               timeshift=timeshift,
+                               _open_queue=False)
+
+        # Log in once and share the access token across the validators we
+        # create for each watchpoint; the queue opens on the first flush.
+        if self._dc_access_token is None:
+            v.login()
+            self._dc_access_token = v.api_access_token
+        else:
+            v.api_access_token = self._dc_access_token
         return v
 
     def get_db_collection_config(self):
         return self._get_db('collections')
 
     def get_table_config_for_table_name(self, name):
-        for entry in self.get_db_collection_config():
-            if entry.get('name', '') == name:
-                #return entry.get('enabled')
-                return entry
-        # endfor
-        return None
+        return self._collections_by_name.get(name)
+
+    def get_enabled_collections(self):
+        return [cc for cc in self.get_db_collection_config() if cc['enabled']]
 
     def get_behavior(self):
         return self._d.get('behavior')
 
     def get_traverse_new_tables(self):
-        b = self.get_behavior()
+        b = self.get_behavior() or {}
         if b.get('new_collections', 'traverse') == 'traverse':
             return True
         return False
@@ -199,7 +369,9 @@ class Config:
     def do_fetch_live_table_list(self):
         live_tables = []
 
-        for coll in self._mongo_db.list_collection_names():
+        # A name-only filter keeps pymongo sending nameOnly=True, and drops
+        # system.* collections in the same round trip.
+        for coll in self._mongo_db.list_collection_names(filter={"name": {"$regex": r"^(?!system\.)"}}):
             live_tables.append(coll)
 
         return live_tables
@@ -210,15 +382,35 @@ class Config:
         # Some unsupported-by-us mechanisms documented at the above url.
         (host, port, dbname, user, password) = self.get_db_mongo()
 
-        client = MongoClient(host, port)
+        client = self.get_mongo_client()
         db = client[dbname]
         return (client, db)
 
+    def get_mongo_client(self):
+        (host, port, dbname, user, password) = self.get_db_mongo()
+
+        # Size the pool for the collection workers rather than pymongo's default
+        # of 100, and fail fast if the server is unreachable instead of waiting
+        # the default 30s per attempt.
+        kwargs = { 'maxPoolSize': self.get_workers(),
+                   'serverSelectionTimeoutMS': 5000 }
+
+        # e.g., "zstd,snappy,zlib"; needs MongoDB 4.2+ for zstd and the matching
+        # python module (zstandard, python-snappy) installed.
+        compressors = self._get_db('compressors')
+        if compressors:
+            kwargs['compressors'] = compressors
+
+        return MongoClient(host, port, **kwargs)
+
 
 class SessionHistory:
     def __init__(self):
         self.history = {}
         self.config = None
+        # collections are fetched on worker threads; serialize cache access.
+        self._lock = threading.RLock()
+        self._conn = None
 
     def set_config(self, config):
         assert isinstance(config, Config)
@@ -226,7 +418,8 @@ class SessionHistory:
 
     def add_history(self, table_name, field, value):
         assert self.config is not None
-        self.history[table_name] = (field, value)
+        with self._lock:
+            self.history[table_name] = (field, value)
         return
     
     def has_history(self, table_name):
@@ -235,30 +428,60 @@ class SessionHistory:
     def get_history(self, table_name):
         return self.history.get(table_name)
     
-    def _get_existing_tables(self, cache_path):
-        assert self.config is not None
-        _tables = []
-        c = sqlite3.connect(cache_path)
-        r = c.execute("select name from sqlite_master where type='table' and name not like 'sqlite_%'")
-        for row in r:
-            _tables.append(row[0])
-        return _tables
-
-    def _handle_new_cache(self, cache_path):
-        assert self.config is not None
-        _tables = self._get_existing_tables(cache_path)
-
-        c = sqlite3.connect(cache_path)
-        if not ("cache" in _tables):
-            c.execute("create table cache (object_name text unique, field_name text, field_value)")
-
-        if not ("sql_log" in _tables):
-            c.execute("create table sql_log (sql text, object_name text, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
-
-        c.commit()
+    def _get_conn(self):
+        # One connection per process, shared by the worker threads under self._lock.
+        if self._conn is None:
+            cache_path = self.config.get_local_cache_file()
+            assert cache_path is not None
+
+            c = sqlite3.connect(cache_path, check_same_thread=False)
+            c.execute("pragma journal_mode=WAL")
+            c.execute("pragma synchronous=NORMAL")
+            c.execute("pragma cache_size=-10000")
+            c.execute("pragma busy_timeout=5000")
+            self._handle_new_cache(c)
+            self._conn = c
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.execute("pragma optimize")
+                self._conn.close()
+                self._conn = None
+        return
 
-        # endif
-    
+    # Markers are almost always ObjectIds or datetimes; store those as plain
+    # values tagged with their type and only pickle anything else.
+    @classmethod
+    def _encode_value(cls, fv):
+        if type(fv) == bson.ObjectId:
+            return ('oid', fv.binary)
+        if type(fv) == datetime:
+            return ('dt', fv.isoformat())
+        return ('pickle', pickle.dumps(fv))
+
+    @classmethod
+    def _decode_value(cls, ft, fv_raw):
+        if ft == 'oid':
+            return bson.ObjectId(bytes(fv_raw))
+        if ft == 'dt':
+            return datetime.fromisoformat(fv_raw)
+        # 'pickle', or NULL from a cache written by an older version.
+        return pickle.loads(fv_raw)
+
+    def _handle_new_cache(self, c):
+        # Runs once, when the connection is opened.
+        with c:
+            c.execute("create table if not exists cache (object_name text unique, field_name text, field_value, field_type text)")
+            c.execute("create table if not exists sql_log (sql text, object_name text, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+            c.execute("create index if not exists idx_sqllog_ts on sql_log (Timestamp)")
+            c.execute("create index if not exists idx_sqllog_obj on sql_log (object_name)")
+
+            # caches written before field_type existed hold pickled values only.
+            _cols = [row[1] for row in c.execute("pragma table_info(cache)")]
+            if not ("field_type" in _cols):
+                c.execute("alter table cache add column field_type text")
         return
 
     def append_sql_log(self, table_name, sql_stmt):
@@ -266,52 +489,43 @@ class SessionHistory:
         assert isinstance(table_name, str)
         assert isinstance(sql_stmt, str)
 
-        cache_path = self.config.get_local_cache_file()
-        c = sqlite3.connect(cache_path)
-        self._handle_new_cache(cache_path)
-        c.execute("insert into sql_log (sql, object_name) values (?,?)", (sql_stmt, table_name))
-        c.commit()
+        with self._lock:
+            c = self._get_conn()
+            c.execute("insert into sql_log (sql, object_name) values (?,?)", (sql_stmt, table_name))
+            c.commit()
         return
 
     def save(self):
         assert self.config is not None
         # write to disk
-        cache_path = self.config.get_local_cache_file()
-        assert cache_path is not None
+        with self._lock:
+            rows = []
+            for table, f_pair in self.history.items():
+                (fn, fv) = f_pair
+                (ft, fv_raw) = self._encode_value(fv)
+                rows.append((table, fn, fv_raw, ft))
 
-        self._handle_new_cache(cache_path)
-
-        c = sqlite3.connect(cache_path)
-        for table, f_pair in self.history.items():
-            (fn, fv) = f_pair
-            fv_pickle = pickle.dumps(fv)
             # Note that this might be dangerous if we add new fields later and we don't set them all...
-            #print(table, fn, fv)
-            c.execute("insert or replace into cache (object_name, field_name, field_value) values (?,?,?)", 
-                      (table, fn, fv_pickle))
-
-        c.commit()
+            c = self._get_conn()
+            with c:
+                c.executemany("insert or replace into cache (object_name, field_name, field_value, field_type) values (?,?,?,?)", 
+                              rows)
 
         return
     
     def load(self):
         assert self.config is not None
-        print("load...")
-        time.sleep(1)
+        logger.debug("load...")
 
         # read from disk
-        cache_path = self.config.get_local_cache_file()
-        assert cache_path is not None
-
-        self._handle_new_cache(cache_path)
-
-        c = sqlite3.connect(cache_path)
-        r = c.execute("select object_name, field_name, field_value from cache")
-        for row in r:
-            (table, fn, fv_pickle) = row
-            fv = pickle.loads(fv_pickle)
-            self.add_history(table, fn, fv)
-        # endfor
+        with self._lock:
+            c = self._get_conn()
+            r = c.execute("select object_name, field_name, field_value, field_type from cache")
+            for row in r:
+                (table, fn, fv_raw, ft) = row
+                fv = self._decode_value(ft, fv_raw)
+                self.add_history(table, fn, fv)
+            # endfor
         return
 
 
@@ -340,8 +554,7 @@ def do_test_config(fname):
     config = Config()
     config.load(fname)
 
-    (host, port, dbname, user, password) = config.get_db_mongo()
-    client = MongoClient(host, port)
+    client = config.get_mongo_client()
 
 
     # get what exists [that we can see anyway]
@@ -385,18 +598,12 @@ def do_test_config(fname):
 def DiscoverDatabasesAndCollections(client):
     d = {}
 
-    for db in client.list_databases():
+    # names only; list_databases() also computes per-database size stats.
+    for db_name in client.list_database_names():
         # find collections in the database
-        db_name = db.get('name', None)
-        if db_name is None:
-            continue
-            continue
-
-        the_db = client[db_name]
-        for coll in the_db.list_collection_names():
-            existing = d.get(db_name, [])
-            existing.append(coll)
-            d[db_name] = existing
+        colls = client[db_name].list_collection_names()
+        if len(colls) > 0:
+            d[db_name] = colls
     return d
 
 def do_discover(fname, counts=False):
@@ -407,9 +614,7 @@ def do_discover(fname, counts=False):
     config = Config()
     config.load(fname)
 
-    (host, port, dbname, user, password) = config.get_db_mongo()
-
-    client = MongoClient(host, port)
+    client = config.get_mongo_client()
 
     d = DiscoverDatabasesAndCollections(client)
     
@@ -424,11 +629,12 @@ def do_discover(fname, counts=False):
             if counts:
                 db_handle = client[db]
                 coll_handle = db_handle[cl]
-                total = coll_handle.count()
+                # collection metadata, not a scan.
+                total = coll_handle.estimated_document_count()
 
                 # create synthetic id.
-                fake_id = bson.ObjectId().from_datetime(datetime.utcnow() - timedelta(days=30))
-                recent = coll_handle.find({"_id": { "$gt": fake_id }}).count()
+                fake_id = bson.ObjectId.from_datetime(datetime.utcnow() - timedelta(days=30))
+                recent = coll_handle.count_documents({"_id": { "$gt": fake_id }})
                 print("   %30s   total = %10s, recent = %10s" % (cl, total, recent))
             else:
                 print("   %s" % cl)
@@ -456,7 +662,7 @@ def do_add(fname, in_db_name):
         else:
             in_db_name = dbname
 
-    client = MongoClient(host, port)
+    client = config.get_mongo_client()
     d = DiscoverDatabasesAndCollections(client)
 
     cc_list = []
@@ -490,91 +696,295 @@ def do_add(fname, in_db_name):
     print("Example yaml to work with:")
     print("--------------------------")
 
-    yaml.safe_dump(db_config, sys.stdout, default_flow_style=False)
+    yaml.dump(db_config, sys.stdout, Dumper=YamlSafeDumper, default_flow_style=False)
 
     return
 
 
-def FetchCollection(name, config, watchpoint, use_timeshift, timeshift_field):
-    print("use_timeshift = %s; timeshift_field = %s", (use_timeshift, timeshift_field))
+_PREFETCH_DONE = object()
+
+def PrefetchCursor(cursor, maxsize=1000):
+    """Iterate a cursor on a background thread so that MongoDB reads overlap with
+       the Validator uploads done by the caller. The bounded queue keeps at most
+       maxsize documents in memory. If the caller stops early (an exception or
+       closing the generator), the producer is stopped and the cursor closed.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def _put(item):
+        # Don't block forever on a full queue once the consumer has gone away.
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _producer():
+        try:
+            for r in cursor:
+                if not _put(r):
+                    return
+        except BaseException as e:
+            if not stop.is_set():
+                _put(e)
+            return
+        _put(_PREFETCH_DONE)
+        return
+
+    t = threading.Thread(target=_producer, daemon=True)
+    t.start()
+
+    try:
+        while True:
+            r = q.get()
+            if r is _PREFETCH_DONE:
+                break
+            if isinstance(r, BaseException):
+                raise r
+            yield r
+        # endwhile
+    finally:
+        stop.set()
+        close = getattr(cursor, 'close', None)
+        if close is not None:
+            close()
+        t.join()
+    return
+
+
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+# _id types we can take a max over when tracking the marker.
+_ORDERABLE_ID_TYPES = (bson.ObjectId, int, float, datetime, str)
+
+class ChangeStreamReader:
+    """Iterate the documents inserted into a collection since resume_token. We're
+       run from cron, so this stops once the change stream has nothing more to
+       return instead of waiting for new inserts. After iterating, resume_token
+       holds the point to resume from on the next run.
+    """
+    def __init__(self, collection, resume_token=None, projection=None, batch_size=1000, max_await_time_ms=1000,
+                 start_at_operation_time=None):
+        pipeline = [{ '$match': { 'operationType': 'insert' } }]
+        if projection is not None:
+            p = { 'fullDocument._id': 1 }
+            for f in projection:
+                p['fullDocument.' + f] = 1
+            pipeline.append({ '$project': p })
+
+        self.resume_token = resume_token
+        self._stream = collection.watch(pipeline,
+                                        resume_after=resume_token,
+                                        start_at_operation_time=start_at_operation_time,
+                                        batch_size=batch_size,
+                                        max_await_time_ms=max_await_time_ms)
+
+    def __iter__(self):
+        with self._stream as stream:
+            while stream.alive:
+                change = stream.try_next()
+                if stream.resume_token is not None:
+                    self.resume_token = stream.resume_token
+                if change is None:
+                    break
+                yield change['fullDocument']
+            # endwhile
+        return
+
+    def close(self):
+        self._stream.close()
+        return
+
+
+# Server error codes for a resume token that has fallen off the oplog:
+# ChangeStreamHistoryLost (4.4+), ChangeStreamFatalError and CappedPositionLost (older servers).
+_CHANGE_STREAM_HISTORY_LOST = (286, 280, 136)
+
+def OpenChangeStream(collection, resume_token, projection, batch_size, start_at_operation_time=None):
+    """Open a ChangeStreamReader; returns None instead if resume_token is too old
+       for the server to resume from.
+    """
+    try:
+        return ChangeStreamReader(collection, resume_token, projection, batch_size,
+                                  start_at_operation_time=start_at_operation_time)
+    except pymongo.errors.OperationFailure as e:
+        if resume_token is None or e.code not in _CHANGE_STREAM_HISTORY_LOST:
+            raise
+        logger.warning("%s: can't resume the change stream (%s)", collection.name, e)
+    return None
+
+
+class ChainedCursor:
+    """Walk several cursors one after the other; close() closes all of them."""
+    def __init__(self, *cursors):
+        self._cursors = cursors
+
+    def __iter__(self):
+        for c in self._cursors:
+            yield from c
+        return
+
+    def close(self):
+        for c in self._cursors:
+            c.close()
+        return
+
+
+def SetValidatorTimeshift(dc, timeshift):
+    # DataCulpaValidator has no public setter; as of dataculpa-client 1.4.1 the
+    # next queue is opened with self._timeshift, so update it between commits.
+    if not hasattr(dc, '_timeshift'):
+        FatalError("This dataculpa-client has no _timeshift; install dataculpa-client>=1.4.1,<1.5")
+    dc._timeshift = timeshift
+    return
+
+
+def FetchCollection(name, config, watchpoint, use_timeshift, timeshift_field, batch_size=1000, fields=None, use_change_stream=False):
+    logger.debug("%s: use_timeshift = %s; timeshift_field = %s", name, use_timeshift, timeshift_field)
     db = config._mongo_db
     collection = db[name]
 
-    gCache.load()
-
     marker_pair = gCache.get_history(name)
     
     query_constraints = {}
+    resume_token = None
+    marker_id = None    # largest _id sent so far, kept alongside the change stream token
 
     if marker_pair is not None:
         (fk, fv) = marker_pair
         # do something with fk and fv.
-        print("found marker_pair: %s, %s" % (fk, fv))
-        query_constraints[fk] = { '$gt': fv }
+        logger.info("%s: found marker_pair: %s, %s", name, fk, fv)
+        if fk == "_change_stream":
+            (resume_token, marker_id) = fv
+        else:
+            marker_id = fv
+            query_constraints[fk] = { '$gt': fv }
+
+        if resume_token is not None and not use_change_stream:
+            # marker_id is None only if the collection was empty; poll from the start.
+            logger.info("%s: switching from the change stream back to polling from _id %s", name, marker_id)
+            if marker_id is not None:
+                query_constraints['_id'] = { '$gt': marker_id }
+            resume_token = None
 
     # I guess we need to sort by _id ASC
     if use_timeshift and timeshift_field is None:
         timeshift_field = "_id"
 
-    if timeshift_field is not None:
-        result = collection.find(query_constraints).sort(timeshift_field, ASCENDING)
+    # Only pull the configured fields over the wire; _id is always returned
+    # and we need the timeshift field to bucket records by day.
+    projection = None
+    if fields:
+        projection = { f: 1 for f in fields }
+        if timeshift_field is not None:
+            projection[timeshift_field] = 1
+
+    stream = None
+    if use_change_stream and resume_token is not None:
+        # the server pushes us only new inserts; no re-query of the collection.
+        stream = OpenChangeStream(collection, resume_token, projection, batch_size)
+        if stream is None:
+            if marker_id is not None:
+                logger.info("%s: catching up from _id %s before reopening the change stream", name, marker_id)
+                query_constraints['_id'] = { '$gt': marker_id }
+            else:
+                logger.info("%s: catching up on the whole collection before reopening the change stream", name)
+
+    start_at = None
+    if use_change_stream and stream is None:
+        # First run, switching over from polling, or an expired token: note the
+        # cluster time before the catch-up find and start the stream there, so
+        # nothing inserted during the pass is missed. Inserts that land mid-pass
+        # can be sent twice.
+        start_at = db.command('ping').get('operationTime')
+        if start_at is None:
+            logger.warning("%s: server returned no operationTime; the change stream starts after the catch-up pass", name)
+
+    if stream is None:
+        # Walk the cursor directly so documents stream from the server in batches
+        # rather than being materialized up front.
+        result = collection.find(query_constraints, projection).batch_size(batch_size)
+        if timeshift_field is not None:
+            result = result.sort(timeshift_field, ASCENDING)
+            if timeshift_field == "_id" and "_id_" in collection.index_information():
+                # pin the plan to the _id index so the sort never falls back to memory;
+                # capped collections created with autoIndexId: false don't have one.
+                result = result.hint([("_id", ASCENDING)])
+
+        if use_change_stream:
+            stream = OpenChangeStream(collection, None, projection, batch_size, start_at_operation_time=start_at)
+            result = ChainedCursor(result, stream)
+    else:
+        result = stream
 
     dc = None
 
     # OK, walk the results.
-    last_id = None
-    last_date = None
+    last_id = marker_id
+    last_day = None
     record_count = 0
     last_had_broken_id = False
 
-    for r in result:
-        if record_count == 0:
-            last_id = r.get('_id')
+    for r in PrefetchCursor(result, maxsize=batch_size):
+        # The marker is the largest _id we've sent, whatever order the cursor walks in.
+        # Embedded-document and Decimal128 _ids don't compare in Python; for those
+        # we keep the first one seen.
+        this_oid = r.get('_id')
+        if last_id is None:
+            last_id = this_oid
+        elif type(this_oid) == type(last_id) and type(this_oid) in _ORDERABLE_ID_TYPES and this_oid > last_id:
+            last_id = this_oid
         record_count += 1
 
         if use_timeshift:
             this_id = r.get(timeshift_field)
-            this_date = None
+            this_day = None     # proleptic Gregorian ordinal, as date.toordinal()
 
             if isinstance(this_id, datetime):
                 # not isinstance(this_id, bson.ObjectId): 
                 #print("can't infer time from non-ObjectId _id: ", this_id)
                 #if not last_had_broken_id:
-                #    last_date = None
+                #    last_day = None
                 #    if dc is not None:
                 #        dc.queue_commit()
                 #        dc = None
                 #    last_had_broken_id = True
                 # look at the timezone...
-                this_date = this_id.date()
+                this_day = this_id.toordinal()
             elif isinstance(this_id, str):
                 # we're going to struggle here...
-                print("Timeshift field \"%s\" came back as a string on record id \"%s\" which is going to be very hard to run date compares... clearly we need to handle this better than exiting."
-                        % (timeshift_field, r.get('_id')))
+                logger.error("Timeshift field \"%s\" came back as a string on record id \"%s\" which is going to be very hard to run date compares... clearly we need to handle this better than exiting.",
+                             timeshift_field, r.get('_id'))
                 os._exit(2)
                 dt = DateUtilParse(this_id)
             elif isinstance(this_id, bson.ObjectId):        
-                # extract the day
-                this_date = this_id.generation_time.date()
-            # endif
-
-            if last_date is not None and this_date != last_date:
-                # if the day has moved, close the queue and open it again.
-                (_queue_id, _result) = dc.queue_commit()
-                print("server_result: __%s__" % _result)
-                dc = None
+                # extract the day straight from the ObjectId's leading 4-byte
+                # timestamp rather than building a generation_time datetime.
+                this_day = _EPOCH_ORDINAL + int.from_bytes(this_id.binary[:4], 'big') // 86400
             # endif
 
-            if dc is None: # this gets run our first time through too.
-                this_date_dt = datetime(year=this_date.year, month=this_date.month, day=this_date.day)
+            if this_day is not None and (dc is None or this_day != last_day):
+                this_date_dt = datetime.fromordinal(this_day)
                 dt = (datetime.utcnow() - this_date_dt).total_seconds()
                 dt = int(dt) # old dataculpa client library expects an int.
-                print("dt = ", dt)
-                dc = config.connect_controller(watchpoint, timeshift=dt)
-
+                logger.debug("%s: dt = %s", name, dt)
+
+                if dc is None: # this gets run our first time through too.
+                    dc = config.connect_controller(watchpoint, timeshift=dt)
+                else:
+                    # if the day has moved, close the queue; the client opens the next
+                    # one on its following flush with the new timeshift, so we keep the
+                    # same validator (and login) instead of reconnecting.
+                    (_queue_id, _result) = dc.queue_commit()
+                    logger.info("%s: server_result: __%s__", name, _result)
+                    SetValidatorTimeshift(dc, dt)
+                # endif
+
+                last_day = this_day
             # endif
-
-            last_date = this_date
         # endif
 
         if dc is None: # note we can enter here even if use_timeshift is true if we hit a weird _id field
@@ -584,30 +994,36 @@ def FetchCollection(name, config, watchpoint, use_timeshift, timeshift_field):
 
     # endfor
 
-    if last_id is not None:
+    if stream is not None and stream.resume_token is not None:
+        # keep the _id too, so turning use_change_stream off (or an expired
+        # token) can go back to polling from where the stream left off.
+        gCache.add_history(name, "_change_stream", (stream.resume_token, last_id))
+        gCache.save()
+    elif last_id is not None:
         gCache.add_history(name, "_id", last_id)
         gCache.save()
     # endif
 
-    print("new records found = ", record_count)
+    logger.info("%s: new records found = %s", name, record_count)
 
     # FIXME: add metadata about the query...
     # dc.queue_metadata(meta)
     if dc is not None:
         (_queue_id, _result) = dc.queue_commit()
-        print("server_result: __%s__" % _result)
+        logger.info("%s: server_result: __%s__", name, _result)
 
     # FIXME: On error, rollback the cache
 
     return
 
 def do_run(fname):
-    print("do_run")
+    logger.debug("do_run")
 
     # load the config
     config = Config()
     config.load(fname)
     gCache.set_config(config)
+    gCache.load()
 
     # connect to the db.
     # if we can't connect, log an error to the cache. -- and post metadata.
@@ -615,24 +1031,29 @@ def do_run(fname):
 
     collection_config = config.get_db_collection_config()
 
-    print("collection_config = ", collection_config)
-
-    for cc in collection_config:
-        name            = cc.get('collection', None)
-        watchpoint      = cc.get('dataculpa_watchpoint', None)
-        enabled         = cc.get('enabled', True)
-        use_timeshift   = cc.get('use_timeshift', True)
-        timeshift_field = cc.get('timeshift_field', None)
-
-        if not enabled:
-            # log it, etc.
-            # probably bring over the tracing logging from other modules.
-            print("collection %s enabled set to False; skipping" % name)
-            continue
+    logger.debug("collection_config = %s", collection_config)
+
+    fetch_args = []
+    for cc in config.get_enabled_collections():
+        fetch_args.append((cc['collection'],
+                           config,
+                           cc.get('dataculpa_watchpoint'),
+                           cc['use_timeshift'],
+                           cc['timeshift_field'],
+                           cc['batch_size'],
+                           cc['fields'],
+                           cc['use_change_stream']))
+    # endfor
 
-        # see if we have a history
-        FetchCollection(name, config, watchpoint, use_timeshift, timeshift_field)
+    # Collections are independent, so fetch them concurrently; MongoClient is
+    # thread-safe and pools its connections.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.get_workers()) as ex:
+        futures = [ex.submit(FetchCollection, *args) for args in fetch_args]
+        for f in futures:
+            f.result()
+    # endwith
 
+    gCache.close()
     return
 
 
@@ -654,6 +1075,9 @@ def main():
 
     args = ap.parse_args()
 
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(threadName)s: %(message)s")
+
     if args.init:
         do_initdb(args.init)
         return